@@ -1,10 +1,32 @@
 import os
 import re
+import sys
 import json
+import weakref
+import atexit
+import queue
+import asyncio
 import logging
-from decimal import Decimal, ROUND_HALF_UP
+import logging.handlers
+
+try:
+    import orjson  # быстрый разбор JSON из WebApp, если установлен
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover
+    _json_loads = json.loads
+from decimal import Decimal, ROUND_HALF_UP, getcontext
+
+# 18 знаков с запасом для сумм в UZS; меньше точность — дешевле каждая операция
+getcontext().prec = 18
+
+try:
+    import _decimal  # noqa: F401 — убеждаемся, что decimal работает на C-расширении
+except ImportError:  # pragma: no cover
+    import warnings
+    warnings.warn("Модуль _decimal недоступен: decimal работает на чистом Python и заметно медленнее.")
 from dataclasses import dataclass, field
-from typing import Dict, List, Tuple, Optional
+from functools import lru_cache
+from typing import Dict, List, Set, Tuple, Optional
 
 from telegram import (
     Update,
@@ -15,130 +37,214 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    PicklePersistence,
     filters,
 )
 
 # ================== CONFIG & LOGGING ==================
-BOT_TOKEN = os.getenv("BOT_TOKEN", "8388611917:AAF4n76JouI7hpaYHKAHxm0AP2uqZFryQis")
+BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://bill-splitter-bot.netlify.app/")
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL, logging.INFO),
-    format="%(asctime)s [%(levelname)s] %(message)s",
-)
+# логи пишутся через очередь: поток event loop не блокируется на stderr,
+# реальный вывод делает фоновый QueueListener
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+_root_logger = logging.getLogger()
+_root_logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+_root_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, _stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 log = logging.getLogger("bill_splitter")
 
 UZS = "UZS"
-Q3 = Decimal("0.001")  # точность для внутренних дробных порций
-Q2 = Decimal("0.01")   # точность для процентов сервиса
+_Q_INT = Decimal("1.")  # целочисленный quantize для fmt_money на границе WebApp
+
+# Единый скомпилированный шаблон parse_dish_freeform: оба формата
+# («имя N шт сумма» и «имя сумма») за один проход движка — блок «N шт» опционален.
+_DISH_RE = re.compile(
+    r"^(?P<name>.*?)\s+(?:(?P<qty>\d+(?:[.,]\d+)?)\s*шт\s+)?(?P<sum>\d+(?:[.,]\d+)?)\s*$",
+    re.IGNORECASE,
+)
 
 
 # ================== DATA MODELS ==================
-@dataclass
+# Внутреннее представление — целые числа в милли-единицах:
+#   количество: милли-штуки (0.7 шт -> 700, 2 шт -> 2000)
+#   деньги:     милли-UZS  (28 000 UZS -> 28 000 000)
+# Вся арифметика идёт в int (в сотни раз быстрее Decimal), Decimal остаётся
+# только на границе парсинга пользовательского ввода и данных WebApp.
+MILLI = 1000
+
+
+@dataclass(slots=True)
 class Dish:
     name: str
-    qty_total: Decimal            # всего штук в позиции (может быть дробным, напр. 0.7)
-    line_total: Decimal           # сумма за всю позицию
-    assigned: List[Decimal] = field(default_factory=list)  # по людям: сколько штук назначили
+    qty_m: int                    # всего милли-штук в позиции (может быть дробным, напр. 0.7 -> 700)
+    line_total_m: int             # сумма за всю позицию, милли-UZS
+    assigned: List[int] = field(default_factory=list)  # по людям: сколько милли-штук назначили
+    assigned_sum_m: int = 0       # сумма assigned, поддерживается инкрементально в обработчиках
+    _unit_price_m: Optional[int] = field(default=None, repr=False)
 
     @property
-    def unit_price(self) -> Decimal:
-        if self.qty_total == 0:
-            return Decimal(0)
-        return (self.line_total / self.qty_total).quantize(Q3, rounding=ROUND_HALF_UP)
+    def unit_price_m(self) -> int:
+        """Цена одной целой штуки, милли-UZS. qty_m/line_total_m после создания не меняются."""
+        if self._unit_price_m is None:
+            if self.qty_m == MILLI:  # типовой случай «1 шт» — без деления
+                self._unit_price_m = self.line_total_m
+            else:
+                self._unit_price_m = 0 if self.qty_m == 0 else self.line_total_m * MILLI // self.qty_m
+        return self._unit_price_m
 
-    def remaining(self) -> Decimal:
-        return (self.qty_total - sum(self.assigned)).quantize(Q3)
+    def remaining_m(self) -> int:
+        return self.qty_m - self.assigned_sum_m
 
 
-@dataclass
+@dataclass(slots=True)
 class Group:
     name: str
     members: List[int]  # индексы участников в Bill.people
 
 
-@dataclass
+@dataclass(slots=True)
 class Bill:
     people: List[str] = field(default_factory=list)
     dishes: List[Dish] = field(default_factory=list)
-    service_pct: Decimal = Decimal("0")  # 0..100
+    service_pct: int = 0  # 0..100
     groups: List[Group] = field(default_factory=list)
+    # Битовая маска «у участника i есть назначения»; бит i поддерживается
+    # обработчиками plus_p/plus_g/clear_person, big-int растёт с числом людей.
+    person_has_assign: int = 0
 
     def ensure_assign_matrix(self):
         for d in self.dishes:
             need = len(self.people) - len(d.assigned)
             if need > 0:
-                d.assigned.extend([Decimal(0)] * need)
+                d.assigned.extend([0] * need)
 
 
-# чат -> состояние
-STATE: Dict[int, Bill] = {}
+# Состояние чата живёт в context.chat_data["bill"] (PTB-персистенция),
+# а не в модульном словаре: нет утечки по chat_id и переживает рестарт.
+STATE_FILE = os.getenv("STATE_FILE", "state.pkl")
 
 
 # ================== HELPERS ==================
+_MONEY_TRANS = str.maketrans({",": " "})
+_COMMA_TO_DOT = str.maketrans({",": "."})
+
+
+@lru_cache(maxsize=1024)
+def _fmt_money_int(n: int) -> str:
+    # суммы в счёте повторяются (одинаковые доли, сервис) — кэш попадает часто
+    return format(n, ",d").translate(_MONEY_TRANS)
+
+
 def fmt_money(n: int | Decimal) -> str:
-    n = int(Decimal(n).quantize(Decimal("1."), rounding=ROUND_HALF_UP))
-    return f"{n:,}".replace(",", " ")
+    # Горячий путь — уже целые UZS; Decimal приходит только с границы WebApp.
+    if not isinstance(n, int):
+        n = int(Decimal(n).quantize(_Q_INT, rounding=ROUND_HALF_UP))
+    return _fmt_money_int(n)
+
+
+def m_to_uzs(m: int) -> int:
+    """Милли-UZS -> целые UZS с округлением HALF_UP."""
+    return (m + 500) // MILLI
+
+
+def fmt_qty_m(m: int) -> str:
+    """Милли-штуки -> строка: целое без дроби, иначе до 3 знаков без хвостовых нулей."""
+    whole, frac = divmod(m, MILLI)
+    if not frac:
+        return str(whole)
+    return f"{whole}.{frac:03d}".rstrip("0")
+
+
+# Подписи кнопок: одна интернированная строка и для клавиатур, и для роутинга.
+LBL_NEW = "🧾 Новый счёт"
+LBL_DISH = "➕ Блюдо"
+LBL_PERSON = "👤 Участник"
+LBL_ASSIGN = "🍽 Назначить"
+LBL_SVC = "⚙️ Сервис"
+LBL_CALC = "🧮 Рассчитать"
+LBL_CANCEL = "Отмена"
+
+# Главная и «Отмена»-клавиатуры неизменны (URL фиксируется на старте) —
+# строим один раз на импорте, а не на каждом сообщении.
+_KB_MAIN = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(LBL_NEW), KeyboardButton(LBL_DISH), KeyboardButton(LBL_PERSON)],
+        [KeyboardButton(LBL_ASSIGN), KeyboardButton(LBL_SVC), KeyboardButton(LBL_CALC)],
+        [KeyboardButton("OPEN", web_app=WebAppInfo(url=WEBAPP_URL))],
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+)
+_KB_CANCEL = ReplyKeyboardMarkup([[KeyboardButton(LBL_CANCEL)]], resize_keyboard=True)
 
 
 def kb_main() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [
-            [KeyboardButton("🧾 Новый счёт"), KeyboardButton("➕ Блюдо"), KeyboardButton("👤 Участник")],
-            [KeyboardButton("🍽 Назначить"), KeyboardButton("⚙️ Сервис"), KeyboardButton("🧮 Рассчитать")],
-            [KeyboardButton("OPEN", web_app=WebAppInfo(url=WEBAPP_URL))],
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False,
-    )
+    return _KB_MAIN
+
+
+def _parse_milli(s: str) -> int:
+    """«28000» / «0,7» -> милли-единицы (28000000 / 700)."""
+    if "." not in s and "," not in s:
+        # обычный случай — целое число, Decimal не нужен
+        return int(s) * MILLI
+    return int((Decimal(s.translate(_COMMA_TO_DOT)) * MILLI).to_integral_value(rounding=ROUND_HALF_UP))
 
 
-def parse_dish_freeform(text: str) -> Tuple[str, Decimal, Decimal]:
+def parse_dish_freeform(text: str) -> Tuple[str, int, int]:
     """
     Поддерживаем два формата:
       1) «ассорти 2 шт 28000»
       2) «плов 45000»  (количество = 1)
-    Возвращает (name, qty_total, line_total)
+    Возвращает (name, qty_m, line_total_m) в милли-единицах.
     """
     s = text.strip()
-    # <name> <qty> шт <sum>
-    m = re.search(r"(.*)\s+(\d+(?:[.,]\d+)?)\s*шт\s+(\d+(?:[.,]\d+)?)\s*$", s, flags=re.I)
-    if m:
-        name = m.group(1).strip()
-        qty = Decimal(m.group(2).replace(",", "."))
-        line_total = Decimal(m.group(3).replace(",", "."))
-        if qty <= 0 or line_total < 0:
-            raise ValueError("Количество должно быть > 0, сумма — ≥ 0.")
-        return name, qty, line_total
-
-    # <name> <sum>  => qty=1
-    m = re.search(r"^(.*)\s+(\d+(?:[.,]\d+)?)\s*$", s)
-    if m:
-        name = m.group(1).strip()
-        qty = Decimal(1)
-        line_total = Decimal(m.group(2).replace(",", "."))
-        if line_total < 0:
-            raise ValueError("Сумма должна быть ≥ 0.")
-        return name, qty, line_total
-
-    raise ValueError(
-        "Не удалось распознать блюдо. Формат: (название) (количество) шт (сумма) — либо (название) (сумма)."
-    )
+    m = _DISH_RE.match(s)
+    if not m:
+        raise ValueError(
+            "Не удалось распознать блюдо. Формат: (название) (количество) шт (сумма) — либо (название) (сумма)."
+        )
+
+    name = m.group("name").strip()
+    qty_s = m.group("qty")
+    qty_m = _parse_milli(qty_s) if qty_s else MILLI
+    line_total_m = _parse_milli(m.group("sum"))
+    if qty_m <= 0 or line_total_m < 0:
+        raise ValueError("Количество должно быть > 0, сумма — ≥ 0.")
+    return name, qty_m, line_total_m
 
 
 def person_checkmarks(bill: Bill) -> List[bool]:
-    marks = []
-    for i, _ in enumerate(bill.people):
-        any_assigned = any(d.assigned and i < len(d.assigned) and d.assigned[i] > 0 for d in bill.dishes)
-        marks.append(any_assigned)
-    return marks
+    # O(N): читаем поддерживаемую инкрементально битовую маску вместо
+    # сканирования всей матрицы назначений на каждой перерисовке.
+    mask = bill.person_has_assign
+    return [bool(mask >> i & 1) for i in range(len(bill.people))]
+
+
+# Постоянные ряды клавиатур — создаём один раз, а не на каждой перерисовке.
+def _pair_rows(
+    btns: List[InlineKeyboardButton], cols: int = 2
+) -> List[List[InlineKeyboardButton]]:
+    """Раскладка кнопок по cols в ряд: клавиатура вдвое короче и меньше JSON в каждом edit."""
+    return [btns[i:i + cols] for i in range(0, len(btns), cols)]
+
+
+_BACK_MAIN_ROW = [InlineKeyboardButton("⬅️ Назад", callback_data="back_main")]
+_BACK_PEOPLE_ROW = [InlineKeyboardButton("⬅️ Назад", callback_data="back_people")]
+_CREATE_GROUP_ROW = [InlineKeyboardButton("➕ Создать группу", callback_data="create_group")]
 
 
 def build_people_keyboard(bill: Bill) -> InlineKeyboardMarkup:
@@ -146,40 +252,32 @@ def build_people_keyboard(bill: Bill) -> InlineKeyboardMarkup:
     Клавиатура выбора: участник или группа.
     В конце есть кнопка «➕ Создать группу» и «⬅️ Назад».
     """
-    rows: List[List[InlineKeyboardButton]] = []
     marks = person_checkmarks(bill)
+    IKB = InlineKeyboardButton  # локальная ссылка: без LOAD_GLOBAL на каждую кнопку
 
-    # Участники
-    for i, name in enumerate(bill.people):
-        mark = " ✅" if marks[i] else ""
-        rows.append(
-            [
-                InlineKeyboardButton(
-                    f"{i+1}. {name}{mark}",
-                    callback_data=f"pick_person:{i}",
-                )
-            ]
-        )
+    # Участники — по двое в ряд
+    rows: List[List[InlineKeyboardButton]] = _pair_rows(
+        [
+            IKB(
+                f"{i+1}. {name}{' ✅' if mark else ''}",
+                callback_data=f"pick_person:{i}",
+            )
+            for i, (name, mark) in enumerate(zip(bill.people, marks))
+        ]
+    )
 
-    # Группы (если есть)
-    for g_idx, g in enumerate(bill.groups):
-        rows.append(
-            [
-                InlineKeyboardButton(
-                    g.name,
-                    callback_data=f"pick_group:{g_idx}",
-                )
-            ]
-        )
+    # Группы (если есть) — имена длинные, оставляем по одной в ряд
+    rows.extend(
+        [IKB(g.name, callback_data=f"pick_group:{g_idx}")]
+        for g_idx, g in enumerate(bill.groups)
+    )
 
     # Создать группу
     if bill.people:
-        rows.append(
-            [InlineKeyboardButton("➕ Создать группу", callback_data="create_group")]
-        )
+        rows.append(_CREATE_GROUP_ROW)
 
     # Назад в главное меню
-    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_main")])
+    rows.append(_BACK_MAIN_ROW)
 
     return InlineKeyboardMarkup(rows)
 
@@ -188,26 +286,22 @@ def build_assign_keyboard_person(bill: Bill, p_idx: int) -> InlineKeyboardMarkup
     """
     Клавиатура назначения блюд для конкретного участника.
     """
-    rows: List[List[InlineKeyboardButton]] = []
-    for i, d in enumerate(bill.dishes):
-        left = (d.qty_total - sum(d.assigned)).quantize(Q3)
-        left_i = int(left) if left >= 0 else 0
-        qty_i = int(d.qty_total)
-        has_this = d.assigned and p_idx < len(d.assigned) and d.assigned[p_idx] > 0
-        mark = " ✅" if has_this else ""
-        label = f"{d.name} ({left_i}/{qty_i}){mark}"
-        rows.append(
-            [
-                InlineKeyboardButton(
-                    label,
-                    callback_data=f"plus_p:{p_idx}:{i}",
-                )
-            ]
-        )
+    prefix = f"plus_p:{p_idx}:"  # общая часть callback_data — форматируем один раз
+    IKB = InlineKeyboardButton
+    rows: List[List[InlineKeyboardButton]] = [
+        [
+            IKB(
+                f"{d.name} ({max(d.remaining_m(), 0) // MILLI}/{d.qty_m // MILLI})"
+                f"{' ✅' if d.assigned and p_idx < len(d.assigned) and d.assigned[p_idx] > 0 else ''}",
+                callback_data=prefix + str(i),
+            )
+        ]
+        for i, d in enumerate(bill.dishes)
+    ]
     rows.append(
-        [InlineKeyboardButton("🔄 Очистить выбор", callback_data=f"clear_person:{p_idx}")]
+        [IKB("🔄 Очистить выбор", callback_data=f"clear_person:{p_idx}")]
     )
-    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_people")])
+    rows.append(_BACK_PEOPLE_ROW)
     return InlineKeyboardMarkup(rows)
 
 
@@ -217,84 +311,64 @@ def build_assign_keyboard_group(bill: Bill, g_idx: int) -> InlineKeyboardMarkup:
     Каждый тап по блюду добавляет 1 условную порцию,
     которая равномерно делится между всеми участниками группы.
     """
-    rows: List[List[InlineKeyboardButton]] = []
-    group = bill.groups[g_idx]
-    member_ids = group.members
-
-    for i, d in enumerate(bill.dishes):
-        # Остаток по блюду
-        left = (d.qty_total - sum(d.assigned)).quantize(Q3)
-        left_i = max(int(left), 0)
-        qty_i = int(d.qty_total)
-
-        # Сколько уже назначено этой группе (суммарно по её участникам)
-        group_qty = sum(
-            d.assigned[m] for m in member_ids
-            if d.assigned and m < len(d.assigned)
-        )
-        has_this = group_qty > 0
-        mark = " ✅" if has_this else ""
-        label = f"{d.name} ({left_i}/{qty_i}){mark}"
-
-        rows.append(
-            [
-                InlineKeyboardButton(
-                    label,
-                    callback_data=f"plus_g:{g_idx}:{i}",
-                )
-            ]
-        )
-
-    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_people")])
+    # после выравнивания матрицы фильтруем индексы один раз —
+    # внутри цикла по блюдам проверка границ уже не нужна
+    bill.ensure_assign_matrix()
+    n_people = len(bill.people)
+    member_ids = [m for m in bill.groups[g_idx].members if m < n_people]
+    prefix = f"plus_g:{g_idx}:"
+    IKB = InlineKeyboardButton
+    rows: List[List[InlineKeyboardButton]] = [
+        [
+            IKB(
+                f"{d.name} ({max(d.remaining_m(), 0) // MILLI}/{d.qty_m // MILLI})"
+                f"{' ✅' if any(d.assigned[m] for m in member_ids) else ''}",
+                callback_data=prefix + str(i),
+            )
+        ]
+        for i, d in enumerate(bill.dishes)
+    ]
+    rows.append(_BACK_PEOPLE_ROW)
     return InlineKeyboardMarkup(rows)
 
 
 def summarize_choices_for_person(bill: Bill, p_idx: int) -> str:
-    parts = []
-    for d in bill.dishes:
-        if d.assigned and p_idx < len(d.assigned) and d.assigned[p_idx] > 0:
-            qty = d.assigned[p_idx]
-            # показываем целые, если целое; иначе до 3 знаков
-            if qty == qty.to_integral():
-                qty_str = str(int(qty))
-            else:
-                qty_str = f"{qty.normalize()}"
-            parts.append(f"• {d.name} × {qty_str}")
+    # вызывается на каждый тап — локальная ссылка на fmt_qty_m и одна comprehension
+    _fmt = fmt_qty_m
+    parts = [
+        f"• {d.name} × {_fmt(d.assigned[p_idx])}"
+        for d in bill.dishes
+        if d.assigned and p_idx < len(d.assigned) and d.assigned[p_idx] > 0
+    ]
     return "\n".join(parts) if parts else "—"
 
 
 def summarize_choices_for_group(bill: Bill, g_idx: int) -> str:
-    group = bill.groups[g_idx]
-    member_ids = group.members
+    bill.ensure_assign_matrix()
+    n_people = len(bill.people)
+    member_ids = [m for m in bill.groups[g_idx].members if m < n_people]
+    _fmt = fmt_qty_m
     parts = []
     for d in bill.dishes:
-        group_qty = sum(
-            d.assigned[m] for m in member_ids
-            if d.assigned and m < len(d.assigned)
-        )
+        group_qty = sum(d.assigned[m] for m in member_ids)
         if group_qty > 0:
-            if group_qty == group_qty.to_integral():
-                qty_str = str(int(group_qty))
-            else:
-                qty_str = f"{group_qty.normalize()}"
-            parts.append(f"• {d.name} × {qty_str}")
+            parts.append(f"• {d.name} × {_fmt(group_qty)}")
     return "\n".join(parts) if parts else "—"
 
 
-def calc_base_total(bill: Bill) -> Decimal:
-    return sum((d.line_total for d in bill.dishes), start=Decimal(0))
+def calc_base_total_m(bill: Bill) -> int:
+    """Сумма всех позиций, милли-UZS."""
+    return sum(d.line_total_m for d in bill.dishes)
 
 
 def format_dishes_list(bill: Bill) -> str:
     if not bill.dishes:
         return "Нет добавленных блюд"
-    lines = []
-    for i, d in enumerate(bill.dishes, start=1):
-        qty_i = int(d.qty_total)
-        unit_i = int(d.unit_price)
-        sum_i = int(d.line_total)
-        lines.append(f"{i}. {d.name} — {qty_i} шт × {fmt_money(unit_i)} {UZS} = {fmt_money(sum_i)} {UZS}")
-    return "\n".join(lines)
+    return "\n".join(
+        f"{i}. {d.name} — {d.qty_m // MILLI} шт × {fmt_money(m_to_uzs(d.unit_price_m))} {UZS}"
+        f" = {fmt_money(m_to_uzs(d.line_total_m))} {UZS}"
+        for i, d in enumerate(bill.dishes, start=1)
+    )
 
 
 # ================== РАСЧЁТ ==================
@@ -308,49 +382,70 @@ def compute_summary_details(bill: Bill) -> Tuple[int, int, List[int], List[int]]
     ЛОГИКА:
       - каждому начисляем назначенные порции: assigned[i] * unit_price
       - если у блюда остался неназначенный остаток (>0) — делим его поровну между ВСЕМИ
-      - округления только в самом конце
+      - вся арифметика в int (микро-UZS), округление только в самом конце
     """
+    # выравниваем матрицу один раз — внутренний цикл без проверок длины
+    bill.ensure_assign_matrix()
     n = max(1, len(bill.people))
-    per_person = [Decimal(0)] * n
-
-    # по всем блюдам: назначенные + остаток поровну
-    for d in bill.dishes:
-        unit = d.unit_price
-        assigned_sum = sum(d.assigned) if d.assigned else Decimal(0)
-        # назначенное
+    # милли-штуки × милли-UZS = микро-UZS
+    per_person_u = [0] * n
+    common_u = 0  # суммарный неназначенный остаток по всем блюдам, микро-UZS
+
+    # частый простой случай — никто ничего не назначал: всё делится поровну,
+    # обходим матрицу назначений целиком
+    if not any(d.assigned_sum_m for d in bill.dishes):
+        common_u = sum(d.qty_m * d.unit_price_m for d in bill.dishes)
+    else:
+        # по всем блюдам: назначенные + остаток поровну
+        for d in bill.dishes:
+            unit_m = d.unit_price_m
+            assigned_sum = d.assigned_sum_m
+            # назначенное
+            for i, take in enumerate(d.assigned):
+                if take:
+                    per_person_u[i] += take * unit_m
+            # остаток (только если реально есть): копим скаляром, раздадим один раз
+            left = d.qty_m - assigned_sum
+            if left > 0:
+                common_u += left * unit_m
+
+    # общий остаток раздаём один раз: O(P) вместо O(D_left × P),
+    # хвост деления — первым rem участникам, сумма сохраняется точно
+    if common_u:
+        share_u, rem = divmod(common_u, n)
         for i in range(n):
-            take = d.assigned[i] if (d.assigned and i < len(d.assigned)) else Decimal(0)
-            if take > 0:
-                per_person[i] += (take * unit)
-        # остаток (только если реально есть)
-        left = (d.qty_total - assigned_sum)
-        if left > 0 and n > 0:
-            share = (left / n)
-            # важно: добавляем именно дробную долю каждому, округление — позже
-            for i in range(n):
-                per_person[i] += (share * unit)
-
-    # переводим в int c округлением HALF_UP
-    per_person_int = [int(x.quantize(Decimal("1."), rounding=ROUND_HALF_UP)) for x in per_person]
-
-    # сумма без сервиса — это сумма по людям (должна совпадать с суммой всех позиций, возможна разница ±1 на округлениях)
-    total_no_service = sum(per_person_int)
-
-    # сервис считаем от КАЖДОГО per_person_int (как у вас в примерах)
-    service_each = [
-        int((Decimal(p) * bill.service_pct / Decimal(100)).quantize(Decimal("1."), rounding=ROUND_HALF_UP))
-        for p in per_person_int
-    ]
-    service_amount_total = sum(service_each)
+            per_person_u[i] += share_u + (1 if i < rem else 0)
+
+    # один проход: микро-UZS -> целые UZS (HALF_UP), сервис с каждого и обе суммы
+    # (сумма без сервиса должна совпадать с суммой позиций, возможна разница ±1 на округлениях;
+    #  сервис считаем от КАЖДОГО per_person_int, как у вас в примерах)
+    pct = bill.service_pct
+    per_person_int = [0] * n
+    service_each = [0] * n
+    total_no_service = 0
+    service_amount_total = 0
+    for i, x in enumerate(per_person_u):
+        p = (x + 500_000) // 1_000_000
+        s = (p * pct + 50) // 100
+        per_person_int[i] = p
+        service_each[i] = s
+        total_no_service += p
+        service_amount_total += s
 
     return total_no_service, service_amount_total, per_person_int, service_each
 
 
+def _get_bill(context: ContextTypes.DEFAULT_TYPE) -> Bill:
+    """Bill текущего чата; создаётся лениво — без лишнего Bill() на каждый вызов."""
+    bill = context.chat_data.get("bill")
+    if bill is None:
+        bill = context.chat_data["bill"] = Bill()
+    return bill
+
+
 # ================== HANDLERS ==================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    if chat_id not in STATE:
-        STATE[chat_id] = Bill()
+    _get_bill(context)
     await update.message.reply_text(
         "Добро пожаловать! Используйте кнопки ниже.\n"
         "Чтобы работать в мини-приложении, нажмите «OPEN».",
@@ -358,159 +453,208 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    text = (update.message.text or "").strip()
-    bill = STATE.setdefault(chat_id, Bill())
+# --- Кнопки главного меню ---
+async def _h_new_bill(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill):
+    context.chat_data["bill"] = Bill()
+    await update.message.reply_text("Новый счёт начат. Добавьте блюда и участников.", reply_markup=kb_main())
 
-    # Новый счёт
-    if text == "🧾 Новый счёт":
-        STATE[chat_id] = Bill()
-        await update.message.reply_text("Новый счёт начат. Добавьте блюда и участников.", reply_markup=kb_main())
-        return
 
-    # Настройка сервиса
-    if text == "⚙️ Сервис":
-        context.user_data["mode"] = "svc"
-        await update.message.reply_text(
-            "Пожалуйста, введите процент сервиса (целое число 0–100):",
-            reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], resize_keyboard=True),
-        )
-        return
+async def _h_service_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill):
+    context.user_data["mode"] = "svc"
+    await update.message.reply_text(
+        "Пожалуйста, введите процент сервиса (целое число 0–100):",
+        reply_markup=_KB_CANCEL,
+    )
 
-    if context.user_data.get("mode") == "svc":
-        if text == "Отмена":
-            context.user_data.pop("mode", None)
-            await update.message.reply_text("Отменено.", reply_markup=kb_main())
-            return
-        try:
-            pct = int(text)
-            pct = max(0, min(100, pct))
-        except Exception:
-            await update.message.reply_text("Только число от 0 до 100, пожалуйста.")
-            return
 
-        bill.service_pct = Decimal(pct)
-        context.user_data.pop("mode", None)
+async def _h_dish_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill):
+    context.user_data["mode"] = "add_dish"
+    await update.message.reply_text(
+        "Пожалуйста, введите позицию. Можно сразу так: (название) (количество) шт (сумма)\n"
+        "Либо: (название) (сумма)",
+        reply_markup=_KB_CANCEL,
+    )
 
-        base_total = calc_base_total(bill)
-        service_total = (base_total * bill.service_pct / Decimal(100)).quantize(Q2, rounding=ROUND_HALF_UP)
-        total = base_total + service_total
-
-        dishes_block = format_dishes_list(bill)
-        msg = (
-            f"✅ Процент сервиса установлен: {pct}%\n\n"
-            f"📋 Список блюд:\n{dishes_block}\n\n"
-            f"🧮 Итого без сервиса: {fmt_money(base_total)} {UZS}\n"
-            f"🧾 Сервис {pct}%: {fmt_money(service_total)} {UZS}\n"
-            f"💰 Итого к оплате: {fmt_money(total)} {UZS}"
-        )
-        await update.message.reply_text(msg, reply_markup=kb_main())
-        return
 
-    # Добавление блюда
-    if text == "➕ Блюдо":
-        context.user_data["mode"] = "add_dish"
-        await update.message.reply_text(
-            "Пожалуйста, введите позицию. Можно сразу так: (название) (количество) шт (сумма)\n"
-            "Либо: (название) (сумма)",
-            reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], resize_keyboard=True),
-        )
-        return
+async def _h_person_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill):
+    context.user_data["mode"] = "add_person"
+    await update.message.reply_text(
+        "Пожалуйста, введите имя участника (или нажмите «Отмена»):",
+        reply_markup=_KB_CANCEL,
+    )
 
-    if context.user_data.get("mode") == "add_dish":
-        if text == "Отмена":
-            context.user_data.pop("mode", None)
-            await update.message.reply_text("Добавление отменено.", reply_markup=kb_main())
-            return
-        try:
-            name, qty, line_total = parse_dish_freeform(text)
-        except Exception as e:
-            await update.message.reply_text(str(e))
-            return
 
-        d = Dish(name=name, qty_total=qty, line_total=line_total)
-        d.assigned = [Decimal(0)] * len(bill.people)
-        bill.dishes.append(d)
-        context.user_data.pop("mode", None)
+async def _h_assign(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill):
+    if not bill.people or not bill.dishes:
+        await update.message.reply_text("Сначала добавьте блюда и участников.", reply_markup=kb_main())
+        return
+    await update.message.reply_text(
+        "Кому назначаем? Выберите участника или группу:",
+        reply_markup=build_people_keyboard(bill),
+    )
 
-        dishes_block = format_dishes_list(bill)
-        base_total = calc_base_total(bill)
-        msg = (
-            f"✅ Блюдо добавлено: {name} — {int(qty)} шт × {fmt_money(int(d.unit_price))} {UZS} = {fmt_money(int(line_total))} {UZS}\n\n"
-            f"📋 Список блюд:\n{dishes_block}\n\n"
-            f"🧮 Сумма без сервиса: {fmt_money(base_total)} {UZS}"
-        )
-        if bill.service_pct and bill.service_pct > 0:
-            service_total = (base_total * bill.service_pct / Decimal(100)).quantize(Q2, rounding=ROUND_HALF_UP)
-            msg += (
-                f"\n🧾 Сервис {int(bill.service_pct)}%: {fmt_money(service_total)} {UZS}"
-                f"\n💰 Итого: {fmt_money(base_total + service_total)} {UZS}"
-            )
-        await update.message.reply_text(msg, reply_markup=kb_main())
+
+async def _h_calc(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill):
+    if not bill.people or not bill.dishes:
+        await update.message.reply_text("Нужно добавить блюда и участников.", reply_markup=kb_main())
         return
 
-    # Добавление участника
-    if text == "👤 Участник":
-        context.user_data["mode"] = "add_person"
-        await update.message.reply_text(
-            "Пожалуйста, введите имя участника (или нажмите «Отмена»):",
-            reply_markup=ReplyKeyboardMarkup([[KeyboardButton("Отмена")]], resize_keyboard=True),
+    base_total, service_total, per_base, per_svc = compute_summary_details(bill)
+
+    # заранее известный размер: шапка + строка на участника, один join в конце
+    lines = [""] * (6 + len(bill.people))
+    lines[0] = "🧮 Итоговый расчёт:"
+    lines[1] = f"Без сервиса: {fmt_money(base_total)} {UZS}"
+    lines[2] = f"Сервис {bill.service_pct}%: {fmt_money(service_total)} {UZS}"
+    lines[3] = f"💰 Итого: {fmt_money(base_total + service_total)} {UZS}"
+    lines[4] = ""
+    lines[5] = "👥 Разбивка по участникам:"
+    for i, (name, b, s) in enumerate(zip(bill.people, per_base, per_svc)):
+        lines[6 + i] = (
+            f"{i + 1}. {name} — {fmt_money(b + s)} {UZS}  "
+            f"(до сервиса: {fmt_money(b)} {UZS}, +{fmt_money(s)} {UZS})"
         )
+    await update.message.reply_text("\n".join(lines), reply_markup=kb_main())
+
+
+# --- Режимы ввода (после нажатия кнопки) ---
+async def _h_mode_svc(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill, text: str):
+    if text == LBL_CANCEL:
+        context.user_data.pop("mode", None)
+        await update.message.reply_text("Отменено.", reply_markup=kb_main())
+        return
+    try:
+        pct = int(text)
+        pct = max(0, min(100, pct))
+    except Exception:
+        await update.message.reply_text("Только число от 0 до 100, пожалуйста.")
         return
 
-    if context.user_data.get("mode") == "add_person":
-        if text == "Отмена":
-            context.user_data.pop("mode", None)
-            await update.message.reply_text("Действие отменено.", reply_markup=kb_main())
-            return
-        name = text.strip()
-        if not name:
-            await update.message.reply_text("Имя не может быть пустым. Повторите, пожалуйста.")
-            return
-        bill.people.append(name)
-        for d in bill.dishes:
-            d.assigned.append(Decimal(0))
+    bill.service_pct = pct
+    context.user_data.pop("mode", None)
+
+    base_m = calc_base_total_m(bill)
+    service_m = (base_m * pct + 50) // 100
+    total_m = base_m + service_m
+
+    dishes_block = format_dishes_list(bill)
+    msg = (
+        f"✅ Процент сервиса установлен: {pct}%\n\n"
+        f"📋 Список блюд:\n{dishes_block}\n\n"
+        f"🧮 Итого без сервиса: {fmt_money(m_to_uzs(base_m))} {UZS}\n"
+        f"🧾 Сервис {pct}%: {fmt_money(m_to_uzs(service_m))} {UZS}\n"
+        f"💰 Итого к оплате: {fmt_money(m_to_uzs(total_m))} {UZS}"
+    )
+    await update.message.reply_text(msg, reply_markup=kb_main())
+
+
+async def _h_mode_add_dish(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill, text: str):
+    if text == LBL_CANCEL:
         context.user_data.pop("mode", None)
-        await update.message.reply_text(
-            f"✅ Добавлен участник: {name}\n👥 Текущий список: " + ", ".join(bill.people),
-            reply_markup=kb_main()
-        )
+        await update.message.reply_text("Добавление отменено.", reply_markup=kb_main())
+        return
+    try:
+        name, qty_m, line_total_m = parse_dish_freeform(text)
+    except Exception as e:
+        await update.message.reply_text(str(e))
         return
 
-    # Назначение блюд
-    if text == "🍽 Назначить":
-        if not bill.people or not bill.dishes:
-            await update.message.reply_text("Сначала добавьте блюда и участников.", reply_markup=kb_main())
-            return
-        await update.message.reply_text(
-            "Кому назначаем? Выберите участника или группу:",
-            reply_markup=build_people_keyboard(bill),
+    d = Dish(name=name, qty_m=qty_m, line_total_m=line_total_m)
+    d.assigned = [0] * len(bill.people)
+    bill.dishes.append(d)
+    context.user_data.pop("mode", None)
+
+    dishes_block = format_dishes_list(bill)
+    base_m = calc_base_total_m(bill)
+    msg = (
+        f"✅ Блюдо добавлено: {name} — {fmt_qty_m(qty_m)} шт × {fmt_money(m_to_uzs(d.unit_price_m))} {UZS}"
+        f" = {fmt_money(m_to_uzs(line_total_m))} {UZS}\n\n"
+        f"📋 Список блюд:\n{dishes_block}\n\n"
+        f"🧮 Сумма без сервиса: {fmt_money(m_to_uzs(base_m))} {UZS}"
+    )
+    if bill.service_pct > 0:
+        service_m = (base_m * bill.service_pct + 50) // 100
+        msg += (
+            f"\n🧾 Сервис {bill.service_pct}%: {fmt_money(m_to_uzs(service_m))} {UZS}"
+            f"\n💰 Итого: {fmt_money(m_to_uzs(base_m + service_m))} {UZS}"
         )
+    await update.message.reply_text(msg, reply_markup=kb_main())
+
+
+async def _h_mode_add_person(update: Update, context: ContextTypes.DEFAULT_TYPE, bill: Bill, text: str):
+    if text == LBL_CANCEL:
+        context.user_data.pop("mode", None)
+        await update.message.reply_text("Действие отменено.", reply_markup=kb_main())
+        return
+    name = text.strip()
+    if not name:
+        await update.message.reply_text("Имя не может быть пустым. Повторите, пожалуйста.")
         return
+    bill.people.append(name)
+    for d in bill.dishes:
+        d.assigned.append(0)
+    context.user_data.pop("mode", None)
+    await update.message.reply_text(
+        f"✅ Добавлен участник: {name}\n👥 Текущий список: " + ", ".join(bill.people),
+        reply_markup=kb_main()
+    )
 
-    # Итоговый расчёт
-    if text == "🧮 Рассчитать":
-        if not bill.people or not bill.dishes:
-            await update.message.reply_text("Нужно добавить блюда и участников.", reply_markup=kb_main())
-            return
 
-        base_total, service_total, per_base, per_svc = compute_summary_details(bill)
+# Диспетчеризация: O(1) по словарю вместо линейной цепочки if/elif.
+_TEXT_ROUTES = {
+    LBL_NEW: _h_new_bill,
+    LBL_SVC: _h_service_prompt,
+    LBL_DISH: _h_dish_prompt,
+    LBL_PERSON: _h_person_prompt,
+    LBL_ASSIGN: _h_assign,
+    LBL_CALC: _h_calc,
+}
+_MODE_ROUTES = {
+    "svc": _h_mode_svc,
+    "add_dish": _h_mode_add_dish,
+    "add_person": _h_mode_add_person,
+}
+
+
+# При concurrent_updates(True) PTB обрабатывает апдейты параллельно, в том
+# числе из одного чата. Блокировка на чат сохраняет порядок внутри чата,
+# не мешая параллелизму между чатами. Локи не попадают в персистенцию.
+# WeakValueDictionary вместо обычного dict, чтобы таблица не росла по чату
+# навсегда: лок жив, пока хоть один обработчик держит на него ссылку
+# (async with в on_text/on_callback), и исчезает вместе с последней.
+_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _chat_lock(chat_id: int) -> asyncio.Lock:
+    # без await между get и записью — на одном event loop гонки нет
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _chat_locks[chat_id] = lock
+    return lock
 
-        lines = [
-            "🧮 Итоговый расчёт:",
-            f"Без сервиса: {fmt_money(base_total)} {UZS}",
-            f"Сервис {int(bill.service_pct)}%: {fmt_money(service_total)} {UZS}",
-            f"💰 Итого: {fmt_money(base_total + service_total)} {UZS}",
-            "",
-            "👥 Разбивка по участникам:",
-        ]
-        for i, name in enumerate(bill.people):
-            lines.append(
-                f"{i+1}. {name} — {fmt_money(per_base[i] + per_svc[i])} {UZS}  "
-                f"(до сервиса: {fmt_money(per_base[i])} {UZS}, +{fmt_money(per_svc[i])} {UZS})"
-            )
-        await update.message.reply_text("\n".join(lines), reply_markup=kb_main())
+
+async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with _chat_lock(update.effective_chat.id):
+        await _on_text(update, context)
+
+
+async def _on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = (update.message.text or "").strip()
+    bill = _get_bill(context)
+
+    # Текстовая команда тоже делает отложенный дебаунс-edit устаревшим:
+    # «Новый счёт» не должен быть перекрыт всплывшей перерисовкой старого
+    _cancel_pending_edit(update.effective_chat.id)
+
+    mode_handler = _MODE_ROUTES.get(context.user_data.get("mode"))
+    if mode_handler is not None:
+        await mode_handler(update, context, bill, text)
+        return
+
+    handler = _TEXT_ROUTES.get(text)
+    if handler is not None:
+        await handler(update, context, bill)
         return
 
     # Фолбэк
@@ -518,23 +662,19 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ================== GROUP SELECT UI ==================
-def build_group_select_keyboard(bill: Bill, selected: List[int]) -> InlineKeyboardMarkup:
+def build_group_select_keyboard(bill: Bill, selected: Set[int]) -> InlineKeyboardMarkup:
     """
     Клавиатура выбора участников для новой группы.
     """
-    rows: List[List[InlineKeyboardButton]] = []
-    selected_set = set(selected)
-
-    for i, name in enumerate(bill.people):
-        mark = " ✅" if i in selected_set else ""
-        rows.append(
-            [
-                InlineKeyboardButton(
-                    f"{i+1}. {name}{mark}",
-                    callback_data=f"group_toggle:{i}",
-                )
-            ]
-        )
+    rows: List[List[InlineKeyboardButton]] = _pair_rows(
+        [
+            InlineKeyboardButton(
+                f"{i+1}. {name}{' ✅' if i in selected else ''}",
+                callback_data=f"group_toggle:{i}",
+            )
+            for i, name in enumerate(bill.people)
+        ]
+    )
 
     # Управляющие кнопки
     rows.append(
@@ -551,7 +691,7 @@ def build_group_select_keyboard(bill: Bill, selected: List[int]) -> InlineKeyboa
 async def show_group_select_screen(
     update: Update,
     bill: Bill,
-    selected: List[int],
+    selected: Set[int],
     flash: Optional[str] = None,
 ):
     """
@@ -572,12 +712,27 @@ async def show_group_select_screen(
 
 # ================== CALLBACKS (назначение + группы) ==================
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # answer() сразу, чтобы у пользователя не «крутилась» кнопка, пока чат занят
+    await update.callback_query.answer()
+    async with _chat_lock(update.effective_chat.id):
+        await _on_callback(update, context)
+
+
+async def _on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    chat_id = update.effective_chat.id
-    bill = STATE.setdefault(chat_id, Bill())
+    bill = _get_bill(context)
+    ud = context.user_data  # один доступ к дескриптору на весь обработчик
     data = query.data or ""
 
+    # Свежий callback делает отложенный дебаунс-edit устаревшим: иначе он
+    # всплывёт после прямого edit'а навигации и визуально «откатит» экран.
+    # А любой уход с экрана назначения инвалидирует запомненный заголовок,
+    # чтобы возврат на тот же экран не свёлся к markup-only edit'у.
+    chat_id = update.effective_chat.id
+    _cancel_pending_edit(chat_id)
+    if not data.startswith(("pick_", "plus_", "clear_person:")):
+        _last_assign_heads.pop(chat_id, None)
+
     # Назад в главное меню
     if data == "back_main":
         await query.edit_message_text("Главное меню. Выберите действие.", reply_markup=kb_main())
@@ -600,8 +755,8 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=build_people_keyboard(bill),
             )
             return
-        context.user_data["group_selected_indices"] = []
-        await show_group_select_screen(update, bill, [])
+        ud["group_selected_indices"] = set()
+        await show_group_select_screen(update, bill, set())
         return
 
     # Тоггл участника при выборе группы
@@ -610,24 +765,21 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             idx = int(data.split(":")[1])
         except Exception:
             return
-        selected: List[int] = context.user_data.get("group_selected_indices", [])
-        if idx in selected:
-            selected.remove(idx)
-        else:
-            selected.append(idx)
-        context.user_data["group_selected_indices"] = selected
+        # set: и проверка, и снятие/установка отметки за O(1)
+        selected: Set[int] = ud.setdefault("group_selected_indices", set())
+        selected.symmetric_difference_update((idx,))
         await show_group_select_screen(update, bill, selected)
         return
 
     # Очистить выбор при создании группы
     if data == "group_clear":
-        context.user_data["group_selected_indices"] = []
-        await show_group_select_screen(update, bill, [])
+        ud["group_selected_indices"] = set()
+        await show_group_select_screen(update, bill, set())
         return
 
     # Отмена создания группы
     if data == "group_cancel":
-        context.user_data.pop("group_selected_indices", None)
+        ud.pop("group_selected_indices", None)
         await query.edit_message_text(
             "Выберите участника или группу:",
             reply_markup=build_people_keyboard(bill),
@@ -636,7 +788,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Завершить создание группы
     if data == "group_done":
-        selected: List[int] = context.user_data.get("group_selected_indices", [])
+        selected: Set[int] = ud.get("group_selected_indices", set())
         if len(selected) < 2:
             await show_group_select_screen(
                 update,
@@ -647,10 +799,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         # Создаём группу
         group_idx = len(bill.groups) + 1
-        names = [bill.people[i] for i in selected]
+        members = sorted(selected)
+        names = [bill.people[i] for i in members]
         name = f"Группа {group_idx} ({', '.join(names)})"
-        bill.groups.append(Group(name=name, members=selected.copy()))
-        context.user_data.pop("group_selected_indices", None)
+        bill.groups.append(Group(name=name, members=members))
+        ud.pop("group_selected_indices", None)
 
         await query.edit_message_text(
             "Группа создана.\n\nВыберите участника или группу:",
@@ -683,11 +836,12 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             p_idx = int(data.split(":")[1])
         except Exception:
             return
-        bill.ensure_assign_matrix()
         if 0 <= p_idx < len(bill.people):
             for d in bill.dishes:
                 if d.assigned and p_idx < len(d.assigned):
-                    d.assigned[p_idx] = Decimal(0)
+                    d.assigned_sum_m -= d.assigned[p_idx]
+                    d.assigned[p_idx] = 0
+            bill.person_has_assign &= ~(1 << p_idx)
         await show_assign_screen_person(update, bill, p_idx, flash="🧹 Выбор очищен.")
         return
 
@@ -698,15 +852,16 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             p_idx, d_idx = int(p_s), int(d_s)
         except Exception:
             return
-        bill.ensure_assign_matrix()
         if d_idx < 0 or d_idx >= len(bill.dishes) or p_idx < 0 or p_idx >= len(bill.people):
             return
         d = bill.dishes[d_idx]
         # проверяем остаток
-        if (sum(d.assigned) + Decimal(1)) > d.qty_total:
+        if d.assigned_sum_m + MILLI > d.qty_m:
             await show_assign_screen_person(update, bill, p_idx, flash="❗ Остатка по позиции нет.")
             return
-        d.assigned[p_idx] = d.assigned[p_idx] + Decimal(1)
+        d.assigned[p_idx] = d.assigned[p_idx] + MILLI
+        d.assigned_sum_m += MILLI
+        bill.person_has_assign |= 1 << p_idx
         await show_assign_screen_person(update, bill, p_idx)
         return
 
@@ -717,14 +872,13 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             g_idx, d_idx = int(g_s), int(d_s)
         except Exception:
             return
-        bill.ensure_assign_matrix()
         if g_idx < 0 or g_idx >= len(bill.groups) or d_idx < 0 or d_idx >= len(bill.dishes):
             return
         group = bill.groups[g_idx]
         d = bill.dishes[d_idx]
 
         # Проверяем остаток по блюду (1 условная порция)
-        if (sum(d.assigned) + Decimal(1)) > d.qty_total:
+        if d.assigned_sum_m + MILLI > d.qty_m:
             await show_assign_screen_group(update, bill, g_idx, flash="❗ Остатка по позиции нет.")
             return
 
@@ -733,29 +887,105 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_assign_screen_group(update, bill, g_idx, flash="❗ В группе нет валидных участников.")
             return
 
-        share = (Decimal(1) / Decimal(len(members))).quantize(Q3, rounding=ROUND_HALF_UP)
-        # Чтобы сумма ровно давала 1, последнему участнику можно скорректировать
-        total_added = Decimal(0)
+        # Делим 1000 милли-штук точно: первым rem участникам достаётся на 1 больше
+        share, rem = divmod(MILLI, len(members))
         for idx, m in enumerate(members):
-            if idx < len(members) - 1:
-                d.assigned[m] = d.assigned[m] + share
-                total_added += share
-            else:
-                # последнему — остаток до 1.0
-                last_share = Decimal(1) - total_added
-                d.assigned[m] = d.assigned[m] + last_share
+            d.assigned[m] = d.assigned[m] + share + (1 if idx < rem else 0)
+            bill.person_has_assign |= 1 << m
+        d.assigned_sum_m += MILLI
 
         await show_assign_screen_group(update, bill, g_idx)
         return
 
 
+# Дебаунс перерисовок: при серии быстрых тапов отправляем только последний edit.
+_EDIT_DEBOUNCE = 0.15  # сек
+_pending_edits: Dict[int, asyncio.Task] = {}
+
+# Последний показанный заголовок экрана назначения: chat_id -> (message_id, head).
+# Эфемерное UI-состояние — живёт вне user_data, чтобы не попадать в пикл
+# персистенции и не переживать рестарт; размер ограничен.
+_MAX_ASSIGN_HEADS = 1024
+_last_assign_heads: Dict[int, Tuple[int, str]] = {}
+
+
+def _remember_assign_head(chat_id: int, message_id: int, head: str) -> None:
+    _last_assign_heads.pop(chat_id, None)
+    if len(_last_assign_heads) >= _MAX_ASSIGN_HEADS:
+        # dict хранит порядок вставки — выбрасываем самый давний чат
+        del _last_assign_heads[next(iter(_last_assign_heads))]
+    _last_assign_heads[chat_id] = (message_id, head)
+
+
+def _cancel_pending_edit(chat_id: int) -> None:
+    prev = _pending_edits.pop(chat_id, None)
+    if prev is not None and not prev.done():
+        prev.cancel()
+
+
+async def _edit_assign_screen(update, head: str, markup: InlineKeyboardMarkup):
+    """
+    Полный edit_message_text — только когда заголовок реально изменился;
+    иначе достаточно editMessageReplyMarkup (меньше байт, без перерендера Markdown).
+    Сами edit'ы дебаунсятся: 20 тапов подряд превращаются в один запрос к API.
+    """
+    query = update.callback_query
+    msg = query.message
+    message_id = msg.message_id if msg else 0
+    chat = update.effective_chat
+    chat_id = chat.id if chat else 0
+    # markup-only допустим только для того же сообщения с тем же заголовком:
+    # сравнение одной строки принимало новый экран за уже отрисованный
+    only_markup = _last_assign_heads.get(chat_id) == (message_id, head)
+    _cancel_pending_edit(chat_id)
+    _pending_edits[chat_id] = asyncio.create_task(
+        _debounced_edit(query, chat_id, message_id, head, markup, only_markup)
+    )
+
+
+async def _debounced_edit(
+    query, chat_id: int, message_id: int, head: str, markup: InlineKeyboardMarkup, only_markup: bool
+):
+    try:
+        await asyncio.sleep(_EDIT_DEBOUNCE)
+        try:
+            if only_markup:
+                await query.edit_message_reply_markup(reply_markup=markup)
+            else:
+                await query.edit_message_text(head, parse_mode="Markdown", reply_markup=markup)
+        except RetryAfter as e:
+            # FloodWait: ждём сколько просит Telegram и повторяем один раз
+            await asyncio.sleep(e.retry_after)
+            try:
+                await query.edit_message_text(head, parse_mode="Markdown", reply_markup=markup)
+            except RetryAfter:
+                # лимит не отпустил — сдаёмся без записи заголовка,
+                # следующий тап перерисует экран полностью
+                return
+            except BadRequest as e2:
+                if "not modified" not in str(e2).lower():
+                    raise
+        except BadRequest as e:
+            # содержимое не изменилось — для нас это не ошибка
+            if "not modified" not in str(e).lower():
+                raise
+        # заголовок считаем показанным только после успешного edit'а:
+        # если задачу отменили, следующий такой же head обязан отрисоваться
+        # полностью, а не выродиться в markup-only
+        _remember_assign_head(chat_id, message_id, head)
+    except asyncio.CancelledError:
+        pass  # пришёл более свежий тап — этот edit уже не нужен
+    finally:
+        if _pending_edits.get(chat_id) is asyncio.current_task():
+            _pending_edits.pop(chat_id, None)
+
+
 async def show_assign_screen_person(
     update: Update,
     bill: Bill,
     p_idx: int,
     flash: Optional[str] = None,
 ):
-    bill.ensure_assign_matrix()
     if p_idx < 0 or p_idx >= len(bill.people):
         return
     chosen = summarize_choices_for_person(bill, p_idx)
@@ -765,11 +995,7 @@ async def show_assign_screen_person(
         f"Нажимайте на блюдо — каждый тап добавляет 1 шт (если есть остаток).\n\n" \
         f"🧾 Выбранные для участника:\n{chosen}"
 
-    await update.callback_query.edit_message_text(
-        head,
-        parse_mode="Markdown",
-        reply_markup=build_assign_keyboard_person(bill, p_idx)
-    )
+    await _edit_assign_screen(update, head, build_assign_keyboard_person(bill, p_idx))
 
 
 async def show_assign_screen_group(
@@ -778,7 +1004,6 @@ async def show_assign_screen_group(
     g_idx: int,
     flash: Optional[str] = None,
 ):
-    bill.ensure_assign_matrix()
     if g_idx < 0 or g_idx >= len(bill.groups):
         return
     group = bill.groups[g_idx]
@@ -790,177 +1015,181 @@ async def show_assign_screen_group(
         f"которая равномерно делится между всеми участниками группы.\n\n" \
         f"🧾 Выбранные для группы:\n{chosen}"
 
-    await update.callback_query.edit_message_text(
-        head,
-        parse_mode="Markdown",
-        reply_markup=build_assign_keyboard_group(bill, g_idx)
-    )
+    await _edit_assign_screen(update, head, build_assign_keyboard_group(bill, g_idx))
 
 
 # ================== HANDLER ДАННЫХ ИЗ WEBAPP ==================
 def _format_webapp_message(data: dict) -> str:
-    log.info("WEBAPP RAW DATA: %s", data)
+    # трассировка WebApp только на DEBUG: при INFO не платим даже за %s-конверсию
+    _dbg = log.isEnabledFor(logging.DEBUG)
+    if _dbg:
+        log.debug("WEBAPP RAW DATA: %s", data)
 
-    service_pct = Decimal(str(data.get("servicePercent", 0)))
+    # процент сервиса в милли-процентах: 12 -> 12000, 12.5 -> 12500
+    pct_raw = data.get("servicePercent", 0)
+    try:
+        pct_m = pct_raw * MILLI if isinstance(pct_raw, int) else int(round(float(pct_raw) * MILLI))
+    except (TypeError, ValueError):
+        pct_m = 0
     participants = data.get("participants", [])
     dishes = data.get("dishes", [])
     groups_data = data.get("groups", [])
 
-    log.info("Parsed service_pct=%s", service_pct)
-    log.info("Participants=%s", participants)
-    log.info("Dishes=%s", dishes)
-    log.info("Groups=%s", groups_data)
+    if _dbg:
+        log.debug("Parsed pct_m=%s", pct_m)
+        log.debug("Participants=%s", participants)
+        log.debug("Dishes=%s", dishes)
+        log.debug("Groups=%s", groups_data)
 
     if not participants or not dishes:
         log.warning("NO PARTICIPANTS OR DISHES RECEIVED")
         return "Нет данных для расчёта."
 
-    # id -> index
+    n_participants = len(participants)
+
+    # id -> index участника; id интернируем, чтобы lookup'ы ниже
+    # сравнивали строки по указателю, а не посимвольно
+    _intern = sys.intern
     id_to_idx: Dict[str, int] = {
-        str(p.get("id")): i for i, p in enumerate(participants) if p.get("id") is not None
+        _intern(str(pid)): i for i, p in enumerate(participants) if (pid := p.get("id")) is not None
     }
-    log.info("id_to_idx map: %s", id_to_idx)
+    log.debug("id_to_idx map: %s", id_to_idx)
 
-    # group_id -> [participant_indices]
-    group_map: Dict[str, List[int]] = {}
+    # Единая таблица целей назначения: id участника -> int-индекс,
+    # id группы -> список индексов. Один dict.get на назначение вместо двух.
+    _person_idx = id_to_idx.get
+    resolved: Dict[str, object] = dict(id_to_idx)
     for g in groups_data:
-        g_id = str(g.get("id"))
-        member_ids = g.get("memberIds", [])
         indices = []
-        for mid in member_ids:
-            if str(mid) in id_to_idx:
-                indices.append(id_to_idx[str(mid)])
-        group_map[g_id] = indices
-    log.info("group_map: %s", group_map)
+        for mid in g.get("memberIds", []):
+            idx = _person_idx(_intern(str(mid)))
+            if idx is not None:
+                indices.append(idx)
+        if indices:
+            resolved[_intern(str(g.get("id")))] = indices
+        else:
+            log.warning("Group %s has no members, skipping assignment", g.get("id"))
+    _resolve = resolved.get
+    log.debug("resolved targets: %s", resolved)
 
-    per_base = [Decimal(0) for _ in participants]
-    base_total = Decimal(0)
+    # та же схема, что в compute_summary_details: милли-штуки × милли-UZS = микро-UZS
+    per_base_u = [0] * n_participants
+    base_total_m = 0
+    common_u = 0  # нераспределённые остатки всех блюд — раздаём один раз в конце
 
     for d in dishes:
-        log.info("Processing dish: %s", d)
+        if _dbg:
+            log.debug("Processing dish: %s", d)
 
-        qty = Decimal(str(d.get("qty", 0)))
-        total_price = Decimal(str(d.get("totalPrice", 0)))
-
-        if qty <= 0:
-            log.warning("Dish qty <= 0, skipping")
+        # WebApp шлёт числа как есть: int остаётся int, float проходит через round
+        qty_raw = d.get("qty", 0)
+        price_raw = d.get("totalPrice", 0)
+        try:
+            qty_m = qty_raw * MILLI if isinstance(qty_raw, int) else int(round(float(qty_raw) * MILLI))
+            price_m = price_raw * MILLI if isinstance(price_raw, int) else int(round(float(price_raw) * MILLI))
+        except (TypeError, ValueError):
+            log.warning("Dish has non-numeric qty/totalPrice, skipping: %s", d)
             continue
 
-        base_total += total_price
-        unit = (total_price / qty).quantize(Q3, rounding=ROUND_HALF_UP)
+        # вырожденные позиции не трогают ни суммы, ни цикл по назначениям
+        if qty_m <= 0 or price_m == 0:
+            log.warning("Dish qty <= 0 or zero price, skipping")
+            continue
 
-        log.info("Dish qty=%s, total=%s, unit=%s", qty, total_price, unit)
+        base_total_m += price_m
+        # qty=1 — большинство позиций: цена единицы равна сумме, деление не нужно
+        unit_m = price_m if qty_m == MILLI else price_m * MILLI // qty_m
 
         # flatAssignments -> корректный источник
         raw_assignments = d.get("flatAssignments", None)
-        assignments = []
-
         if isinstance(raw_assignments, list):
             # flat: [participantId|groupId|null, ...]
-            assignments = [str(a) if a not in (None, "") else None for a in raw_assignments]
-            log.info("Using flatAssignments=%s", assignments)
+            assignments = [_intern(str(a)) if a not in (None, "") else None for a in raw_assignments]
+            log.debug("Using flatAssignments=%s", assignments)
         else:
             # legacy matrix fallback
             matrix = d.get("assignments", [])
-            log.info("Legacy 'assignments' matrix: %s", matrix)
+            log.debug("Legacy 'assignments' matrix: %s", matrix)
+            assignments = []
             for unit_assignees in matrix:
                 pid = None
                 if isinstance(unit_assignees, list):
                     for a in unit_assignees:
                         if isinstance(a, dict) and a.get("type") == "participant":
-                            pid = str(a.get("id"))
+                            pid = _intern(str(a.get("id")))
                             break
                 assignments.append(pid)
 
-        qty_int = int(qty)
-        if len(assignments) < qty_int:
-            assignments.extend([None] * (qty_int - len(assignments)))
-
-        log.info("Final assignments expanded=%s", assignments)
-
-        assigned_units = Decimal(0)
-
-        # назначенные единицы
-        for a in assignments[:qty_int]:
-            if a is None:
-                continue
-            
-            # 1. Проверяем, это участник?
-            if a in id_to_idx:
-                idx = id_to_idx[a]
-                per_base[idx] += unit
-                assigned_units += Decimal(1)
-                log.info("Assigned 1 unit to Person %s → idx=%s", a, idx)
-            
-            # 2. Проверяем, это группа?
-            elif a in group_map:
-                members = group_map[a]
-                if members:
-                    share = unit / Decimal(len(members))
-                    for m_idx in members:
-                        per_base[m_idx] += share
-                    assigned_units += Decimal(1)
-                    log.info("Assigned 1 unit to Group %s → members=%s, share_each=%s", a, members, share)
-                else:
-                    log.warning("Group %s has no members, skipping assignment", a)
-
-        # остаток поровну всем
-        left = qty - assigned_units
-        if left > 0 and len(participants) > 0:
-            share = left / Decimal(len(participants))
-            log.info("Leftover=%s, share_each=%s", left, share)
-            for i in range(len(participants)):
-                per_base[i] += (share * unit)
-
-    log.info("PER BASE BEFORE ROUNDING: %s", per_base)
-
-    # сервис
-    per_svc = [
-        (b * service_pct / Decimal(100)).quantize(Q2, rounding=ROUND_HALF_UP)
-        for b in per_base
-    ]
-    log.info("PER SERVICE: %s", per_svc)
-
-    service_total = (base_total * service_pct / Decimal(100)).quantize(Q2, rounding=ROUND_HALF_UP)
+        qty_int = qty_m // MILLI
 
-    log.info("TOTAL base=%s, service_total=%s, grand=%s",
-             base_total, service_total, base_total + service_total)
+        # нормализуем назначения один раз: остаются только распознанные цели,
+        # во внутреннем цикле нет ни None-пропусков, ни двойных lookup'ов
+        plan = [t for a in assignments[:qty_int] if a is not None and (t := _resolve(a)) is not None]
+        if _dbg:
+            log.debug("Resolved plan=%s", plan)
 
-    # Формируем сообщение
-    lines = [
-        "🧮 Итоговый расчёт:",
-        f"Без сервиса: {fmt_money(base_total)} {UZS}",
-        f"Сервис {int(service_pct)}%: {fmt_money(service_total)} {UZS}",
-        f"💰 Итого: {fmt_money(base_total + service_total)} {UZS}",
-        "",
-        "👥 Разбивка по участникам:",
-    ]
-
-    for i, p in enumerate(participants, start=1):
-        name = p.get("name", f"Участник {i}")
-
-        base_i = int(per_base[i - 1].quantize(Decimal("1."), rounding=ROUND_HALF_UP))
-        svc_i = int(per_svc[i - 1].quantize(Decimal("1."), rounding=ROUND_HALF_UP))
+        unit_u = MILLI * unit_m  # цена одной штуки, микро-UZS
+        for target in plan:
+            if type(target) is int:
+                per_base_u[target] += unit_u
+            else:
+                # группа: точное деление, хвост — первым участникам
+                share_u, rem = divmod(unit_u, len(target))
+                for j, m_idx in enumerate(target):
+                    per_base_u[m_idx] += share_u + (1 if j < rem else 0)
+
+        # остаток поровну всем — копим скаляром
+        left_m = qty_m - len(plan) * MILLI
+        if left_m > 0:
+            common_u += left_m * unit_m
+
+    if common_u:
+        share_u, rem = divmod(common_u, n_participants)
+        for i in range(n_participants):
+            per_base_u[i] += share_u + (1 if i < rem else 0)
+
+    if _dbg:
+        log.debug("PER BASE (micro-UZS): %s", per_base_u)
+
+    # итоги по счёту: сервис от общей суммы; по участникам — от их базы
+    base_total = m_to_uzs(base_total_m)
+    service_total = (base_total * pct_m + 50_000) // 100_000
+    pct_disp = pct_m // MILLI
+
+    log.debug("TOTAL base=%s, service_total=%s, grand=%s",
+              base_total, service_total, base_total + service_total)
+
+    # один проход по участникам: округление, сервис и готовая строка сразу
+    _fmt = fmt_money
+    lines = [""] * (6 + n_participants)
+    lines[0] = "🧮 Итоговый расчёт:"
+    lines[1] = f"Без сервиса: {_fmt(base_total)} {UZS}"
+    lines[2] = f"Сервис {pct_disp}%: {_fmt(service_total)} {UZS}"
+    lines[3] = f"💰 Итого: {_fmt(base_total + service_total)} {UZS}"
+    lines[4] = ""
+    lines[5] = "👥 Разбивка по участникам:"
+
+    for i, p in enumerate(participants):
+        name = p.get("name", f"Участник {i + 1}")
+        base_i = (per_base_u[i] + 500_000) // 1_000_000
+        svc_i = (base_i * pct_m + 50_000) // 100_000
         total_i = base_i + svc_i
-
-        log.info("Participant %s — base=%s, svc=%s, total=%s",
-                 name, base_i, svc_i, total_i)
-
-        lines.append(
-            f"{i}. {name} — {fmt_money(total_i)} {UZS}  "
-            f"(до сервиса: {fmt_money(base_i)} {UZS}, +{fmt_money(svc_i)} {UZS})"
+        if _dbg:
+            log.debug("Participant %s — base=%s, svc=%s, total=%s", name, base_i, svc_i, total_i)
+        lines[6 + i] = (
+            f"{i + 1}. {name} — {_fmt(total_i)} {UZS}  "
+            f"(до сервиса: {_fmt(base_i)} {UZS}, +{_fmt(svc_i)} {UZS})"
         )
 
     return "\n".join(lines)
 
-
 async def on_web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     wad = update.message.web_app_data  # type: ignore[attr-defined]
     if not wad:
         return
 
     try:
-        data = json.loads(wad.data or "{}")
+        data = _json_loads(wad.data or "{}")
     except Exception as e:
         log.exception("Bad web_app_data JSON: %s", e)
         await update.message.reply_text("Не удалось прочитать итог из WebApp.", reply_markup=kb_main())
@@ -977,15 +1206,50 @@ async def post_init(application: Application) -> None:
 
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    if not BOT_TOKEN:
+        raise SystemExit("BOT_TOKEN не задан — укажите токен в переменной окружения BOT_TOKEN.")
+
+    # опциональный uvloop — ставим ДО сборки Application, чтобы PTB создал цикл уже на нём
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # широкий пул под параллельные ответы из многих чатов;
+        # отдельный запрос для getUpdates — long-poll держит соединение подолгу
+        .request(HTTPXRequest(connection_pool_size=256, connect_timeout=5.0, read_timeout=10.0, pool_timeout=3.0))
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, connect_timeout=5.0, read_timeout=65.0))
+        .post_init(post_init)
+        .concurrent_updates(True)
+        .persistence(PicklePersistence(filepath=STATE_FILE))
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, on_web_app_data))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
     app.add_handler(CallbackQueryHandler(on_callback))
 
-    log.info("Бот запущен (polling). LOG_LEVEL=%s", LOG_LEVEL)
-    app.run_polling(close_loop=False)
+    public_url = os.getenv("PUBLIC_URL")
+    if public_url:
+        port = int(os.getenv("PORT", "8443"))
+        log.info("Бот запущен (webhook, port=%s). LOG_LEVEL=%s", port, LOG_LEVEL)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{public_url.rstrip('/')}/{BOT_TOKEN}",
+            secret_token=os.getenv("WEBHOOK_SECRET") or None,
+            close_loop=False,
+        )
+    else:
+        # Фолбэк для локальной разработки без публичного URL.
+        log.info("Бот запущен (polling). LOG_LEVEL=%s", LOG_LEVEL)
+        app.run_polling(close_loop=False)
 
 
 if __name__ == "__main__":
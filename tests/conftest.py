@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# bot.py лежит в корне репозитория, пакета нет — добавляем корень в путь
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
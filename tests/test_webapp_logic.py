@@ -0,0 +1,114 @@
+import pytest
+
+from bot import _format_webapp_message
+
+
+def _mock_data() -> dict:
+    # Сценарий: три участника, блюдо 1 (100k) на группу 1 (User 1, User 2),
+    # блюдо 2 (140k) на группу 2 (User 2, User 3), сервис 12%.
+    return {
+        "type": "calculation",
+        "servicePercent": 12,
+        "participants": [
+            {"id": "p_1", "name": "User 1"},
+            {"id": "p_2", "name": "User 2"},
+            {"id": "p_3", "name": "User 3"},
+        ],
+        "groups": [
+            {"id": "g_1", "name": "Group 1", "memberIds": ["p_1", "p_2"]},
+            {"id": "g_2", "name": "Group 2", "memberIds": ["p_2", "p_3"]},
+        ],
+        "dishes": [
+            {
+                "id": "d_1",
+                "name": "Dish 1",
+                "qty": 1,
+                "totalPrice": 100000,
+                "flatAssignments": ["g_1"],
+            },
+            {
+                "id": "d_2",
+                "name": "Dish 2",
+                "qty": 1,
+                "totalPrice": 140000,
+                "flatAssignments": ["g_2"],
+            },
+        ],
+    }
+
+
+def test_group_assignments():
+    result = _format_webapp_message(_mock_data())
+    assert "Без сервиса: 240 000 UZS" in result
+    assert "Сервис 12%: 28 800 UZS" in result
+    assert "💰 Итого: 268 800 UZS" in result
+    # 100k пополам на User 1/2, 140k пополам на User 2/3, плюс 12% сервиса
+    assert "1. User 1 — 56 000 UZS  (до сервиса: 50 000 UZS, +6 000 UZS)" in result
+    assert "2. User 2 — 134 400 UZS  (до сервиса: 120 000 UZS, +14 400 UZS)" in result
+    assert "3. User 3 — 78 400 UZS  (до сервиса: 70 000 UZS, +8 400 UZS)" in result
+
+
+def test_unassigned_split_evenly():
+    data = _mock_data()
+    for d in data["dishes"]:
+        d["flatAssignments"] = [None]
+    result = _format_webapp_message(data)
+    # 240k на троих: 80k базы и 9.6k сервиса каждому
+    assert result.count("— 89 600 UZS  (до сервиса: 80 000 UZS, +9 600 UZS)") == 3
+    assert "💰 Итого: 268 800 UZS" in result
+
+
+def test_legacy_assignments_matrix():
+    data = _mock_data()
+    data["dishes"] = [
+        {
+            "id": "d_1",
+            "name": "Dish 1",
+            "qty": 2,
+            "totalPrice": 100000,
+            "assignments": [
+                [{"type": "participant", "id": "p_1"}],
+                [{"type": "participant", "id": "p_2"}],
+            ],
+        },
+    ]
+    result = _format_webapp_message(data)
+    assert "1. User 1 — 56 000 UZS" in result
+    assert "2. User 2 — 56 000 UZS" in result
+    assert "3. User 3 — 0 UZS" in result
+
+
+def test_fractional_qty_leftover():
+    data = _mock_data()
+    data["servicePercent"] = 0
+    data["dishes"] = [
+        {"id": "d_1", "name": "Dish 1", "qty": 1.5, "totalPrice": 4500,
+         "flatAssignments": ["p_1"]},
+    ]
+    result = _format_webapp_message(data)
+    # штука стоит 3 000: одна у User 1, пол-штуки (1 500) поровну на троих
+    assert "1. User 1 — 3 500 UZS" in result
+    assert "2. User 2 — 500 UZS" in result
+    assert "3. User 3 — 500 UZS" in result
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"servicePercent": 10, "participants": [], "dishes": [], "groups": []},
+        {"servicePercent": 10, "participants": [{"id": "p_1", "name": "A"}],
+         "dishes": [], "groups": []},
+    ],
+)
+def test_empty_payload(data):
+    assert _format_webapp_message(data) == "Нет данных для расчёта."
+
+
+def test_degenerate_dishes_skipped():
+    data = _mock_data()
+    data["dishes"].append(
+        {"id": "d_3", "name": "Empty", "qty": 0, "totalPrice": 999,
+         "flatAssignments": []}
+    )
+    result = _format_webapp_message(data)
+    assert "Без сервиса: 240 000 UZS" in result